@@ -403,7 +403,7 @@ _C.DATA.TEST_CROP_SIZE = 256
 # frame sampling.
 _C.DATA.TARGET_FPS = 30
 
-# Decoding backend, options include `pyav` or `torchvision`
+# Decoding backend, options include `pyav`, `torchvision`, `ffmpeg` or `decord`
 _C.DATA.DECODING_BACKEND = "pyav"
 
 # if True, sample uniformly in [1 / max_scale, 1 / min_scale] and take a
@@ -423,6 +423,11 @@ _C.DATA.ENSEMBLE_METHOD = "sum"
 # If True, revert the default input channel (RBG <-> BGR).
 _C.DATA.REVERSE_INPUT_CHANNEL = False
 
+# If True, the HowTo100M loader returns the frames in float16, halving the
+# worker to main process and host to device transfers. Only supported by the
+# vit models, which cast the frames back in their patch embedding.
+_C.DATA.FP16 = False
+
 # fix duration
 _C.DATA.FD = 0.
 # fix end time
@@ -562,6 +567,18 @@ _C.DATA_LOADER.PIN_MEMORY = True
 # Enable multi thread decoding.
 _C.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE = False
 
+# If True, keep the data loader workers (and their datasets) alive across
+# epochs instead of recreating them. Only used when NUM_WORKERS > 0.
+_C.DATA_LOADER.PERSISTENT_WORKERS = False
+
+# Number of batches loaded in advance by each worker. Only used when
+# NUM_WORKERS > 0.
+_C.DATA_LOADER.PREFETCH_FACTOR = 2
+
+# If True, copy the next training batch to the GPU on a side CUDA stream while
+# the current batch is processed. Needs PIN_MEMORY to overlap the copies.
+_C.DATA_LOADER.CUDA_PREFETCH = False
+
 
 # ---------------------------------------------------------------------------- #
 # Detection options.
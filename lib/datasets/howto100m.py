@@ -1,10 +1,12 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates. All Rights Reserved.
 
+import csv
+import functools
 import os
+from collections import defaultdict
 import random
 import torch
 import torch.utils.data
-from fvcore.common.file_io import PathManager
 import numpy as np
 import json
 import lib.utils.logging as logging
@@ -23,49 +25,184 @@ import math
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Packed text embeddings written by tools/pack_text_emb.py. The index holds
+# the sorted video `ids` and the `offsets` and `counts` of their rows.
+PACKED_EMB = "all_emb.npy"
+PACKED_EMB_INDEX = "all_emb_index.npz"
 
-def check_time(s1, e1, s2, e2):
-    return max(min(e1, e2) - max(s1, s2), 0)
 
+@functools.lru_cache(maxsize=4096)
+def load_captions(path_to_caption):
+    """
+    Load the ASR sentences of a video. Videos are revisited across epochs (and
+    within one with EPOCH_MUL), so the parsed captions are cached per worker.
+    Args:
+        path_to_caption (str): path to the csv file with `text`, `start` and
+            `end` columns.
+    Returns:
+        text (ndarray): the ASR sentences.
+        start (ndarray): start time of every sentence in seconds.
+        end (ndarray): end time of every sentence in seconds.
+    """
+    cap = pd.read_csv(path_to_caption)
+    columns = cap["text"].values, cap["start"].values, cap["end"].values
+    for column in columns:
+        # The arrays are shared by every lookup of this video.
+        column.setflags(write=False)
+    return columns
 
-def get_video(video_path, start, end, number_frames):
-    
-    cmd = (
-        ffmpeg
-        .input(video_path, ss=start, t=end-start)
-        .filter('fps', fps=math.ceil(number_frames/(end-start)))
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(text_model):
+    """
+    Return the tokenizer of the given text model, or None if it is not
+    supported. The tokenizer is created once per process.
+    """
+    if text_model != "paraphrase-mpnet-base-v2":
+        return None
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained("sentence-transformers/" + text_model)
+
+
+@functools.lru_cache(maxsize=64)
+def tokenize_captions(path_to_caption, text_model, max_len):
+    """
+    Tokenize all the ASR sentences of a video in one batched call. Only used
+    in testing, where the ensemble views and spatial crops of a video are
+    read one after the other; the ids are stored as int32 to keep the cache
+    small.
+    Args:
+        path_to_caption (str): path to the csv file of the captions.
+        text_model (str): name of the text model, see `get_tokenizer`.
+        max_len (int): every sentence is padded or truncated to max_len tokens.
+    Returns:
+        tokens (dict): tokenizer outputs, each an int32 tensor with one row
+            per sentence.
+    """
+    text, _, _ = load_captions(path_to_caption)
+    sentences = [sen if isinstance(sen, str) and len(sen) > 0 else " " for sen in text]
+    tokens = get_tokenizer(text_model)(
+        sentences,
+        max_length=max_len,
+        padding="max_length",
+        truncation=True,
+        add_special_tokens=True,
+        return_tensors="pt",
     )
-    cmd = (
-            cmd.filter('scale', 640, 360)
-        )
+    return {k: v.int() for k, v in tokens.items()}
+
+
+@functools.lru_cache(maxsize=8)
+def get_video_reader(video_path, threads=1):
+    """
+    Open the video with decord, resized to 640x360. The last opened readers
+    are kept per worker, so consecutive clips of the same video (e.g. the
+    ensemble views in testing) do not reopen the container and the codec.
+    """
+    from decord import VideoReader, cpu
+
+    return VideoReader(
+        video_path, ctx=cpu(0), width=640, height=360, num_threads=threads
+    )
+
+
+def get_video(video_path, start, end, number_frames, threads=1):
+    """
+    Decode the clip in-process with decord. Only the frames that are sampled
+    are decoded, so no temporal sampling is needed afterwards.
+    Args:
+        video_path (str): path to the video.
+        start (float): start time of the clip in seconds.
+        end (float): end time of the clip in seconds.
+        number_frames (int): number of frames to sample uniformly from the clip.
+        threads (int): number of decoding threads, 0 lets the decoder decide.
+    Returns:
+        frames (tensor): decoded frames of the clip, dimension is
+            `num clip frames` x `height` x `width` x `channel`. None if the
+            clip starts after the end of the video.
+    """
+    vr = get_video_reader(video_path, threads)
+    fps = vr.get_avg_fps()
+    start_idx = int(start * fps)
+    if start_idx >= len(vr):
+        # The clip time is past the end of the video, there are no frames to
+        # decode.
+        return None
+    end_idx = max(min(int(end * fps), len(vr)) - 1, start_idx)
+    index = np.linspace(start_idx, end_idx, number_frames).astype(np.int64)
+    np.clip(index, 0, len(vr) - 1, out=index)
+    video = vr.get_batch(index).asnumpy()
+    return torch.from_numpy(video)
+
+
+def get_video_ffmpeg(video_path, start, end, number_frames, threads=1):
+    """
+    Decode the clip with an ffmpeg subprocess, piping back only the sampled
+    frames resized to 640x360.
+    Args:
+        video_path (str): path to the video.
+        start (float): start time of the clip in seconds.
+        end (float): end time of the clip in seconds.
+        number_frames (int): number of frames to sample uniformly from the clip.
+        threads (int): number of decoding threads, 0 lets the decoder decide.
+    Returns:
+        frames (tensor): decoded frames of the clip, dimension is
+            `num clip frames` x `height` x `width` x `channel`.
+    """
+    # Select the first frame at or after each of the `number_frames` uniformly
+    # spaced timestamps, so only the sampled frames are scaled and piped back.
+    # `ss` is an input option, hence timestamps restart from 0 at `start`.
+    step = (end - start) / number_frames
+    select = "+".join(
+        ["isnan(prev_selected_t)"]
+        + [
+            "gte(t,{0:.4f})*lt(prev_selected_t,{0:.4f})".format(i * step)
+            for i in range(1, number_frames)
+        ]
+    )
+    # Every data loader worker runs its own ffmpeg process, so cap the decoder
+    # and filter graph threads to avoid oversubscribing the CPU.
+    cmd = ffmpeg.input(video_path, ss=start, t=end-start, threads=threads)
     out, _ = (
-        cmd.output('pipe:', format='rawvideo', pix_fmt='rgb24')
+        cmd.output(
+            'pipe:',
+            format='rawvideo',
+            pix_fmt='rgb24',
+            vf="select='{}',scale=640:360".format(select),
+            vsync='vfr',
+            threads=threads,
+        )
+        .global_args('-filter_threads', str(threads))
         .run(capture_stdout=False, quiet=True)
     )
     
     video = np.frombuffer(out, np.uint8).reshape([-1, 360, 640, 3])
-    video2 = torch.tensor(video)
-    video2 = temporal_sampling(video2, 0, video2.shape[0], number_frames)
-    return video2  
+    if video.shape[0] != number_frames:
+        # The clip is shorter than expected, pad by repeating frames.
+        video = temporal_sampling(video, 0, video.shape[0], number_frames)
+    return torch.tensor(video)
+
 
 def temporal_sampling(frames, start_idx, end_idx, num_samples):
     """
     Given the start and end frame index, sample num_samples frames between
     the start and end with equal interval.
+    The sampling is done in NumPy on the decoded frames, since for a few
+    frames the per-op overhead of torch dominates.
     Args:
-        frames (tensor): a tensor of video frames, dimension is
-            `num video frames` x `channel` x `height` x `width`.
+        frames (ndarray): an array of video frames, dimension is
+            `num video frames` x `height` x `width` x `channel`.
         start_idx (int): the index of the start frame.
         end_idx (int): the index of the end frame.
         num_samples (int): number of frames to sample.
     Returns:
-        frames (tersor): a tensor of temporal sampled video frames, dimension is
-            `num clip frames` x `channel` x `height` x `width`.
+        frames (ndarray): an array of temporal sampled video frames, dimension
+            is `num clip frames` x `height` x `width` x `channel`.
     """
-    index = torch.linspace(start_idx, end_idx, num_samples)
-    index = torch.clamp(index, 0, frames.shape[0] - 1).long()
-    frames = torch.index_select(frames, 0, index)
-    return frames
+    index = np.linspace(start_idx, end_idx, num_samples).astype(np.int64)
+    np.clip(index, 0, frames.shape[0] - 1, out=index)
+    return frames[index]
 
 def get_start_end_idx(video_size, clip_size, clip_idx, num_clips):
     """
@@ -136,13 +273,15 @@ class Howto100m(torch.utils.data.Dataset):
             "test",
         ], "Split '{}' not supported for HowTo100M".format(mode)
         self.mode = mode
-        import copy
-
-        self.cfg = copy.deepcopy(cfg)
-        if hasattr(self.cfg.MODEL, "NUM_SEG") and self.cfg.MODEL.NUM_SEG > 0:
-            self.cfg.DATA.NUM_FRAMES *= self.cfg.MODEL.NUM_SEG
-
-        self._video_meta = {}
+        # The configs are only read, so keep a reference instead of a deep
+        # copy. The number of frames to decode covers all the segments.
+        self.cfg = cfg
+        self._num_frames = cfg.DATA.NUM_FRAMES
+        if hasattr(cfg.MODEL, "NUM_SEG") and cfg.MODEL.NUM_SEG > 0:
+            self._num_frames *= cfg.MODEL.NUM_SEG
+
+        # Only filled on demand by the torchvision decoder.
+        self._video_meta = defaultdict(dict)
         self._num_retries = num_retries
         # For training or validation mode, one single clip is sampled from every
         # video. For testing, NUM_ENSEMBLE_VIEWS clips are sampled from every
@@ -159,24 +298,16 @@ class Howto100m(torch.utils.data.Dataset):
 
         if len(cfg.TRAIN.TEXT) > 0:
             self.caps = cfg.TRAIN.TEXT
-            self.labels = None
         else:
-            self.labels = None
             self.caps = None
         if len(cfg.TRAIN.TEXT_EMB) > 0:
             self.caps_emb = cfg.TRAIN.TEXT_EMB
         else:
             self.caps_emb = None
+        self._load_packed_emb()
+        self.min_len = 0
         if len(cfg.TRAIN.TEXT) > 0:
-            from transformers import AutoTokenizer
-
-            self.tokenizer = (
-                AutoTokenizer.from_pretrained(
-                    "sentence-transformers/paraphrase-mpnet-base-v2"
-                )
-                if cfg.MODEL.TEXT_MODEL == "paraphrase-mpnet-base-v2"
-                else None
-            )
+            self.tokenizer = get_tokenizer(cfg.MODEL.TEXT_MODEL)
             if hasattr(cfg.MODEL, "MAX_LEN"):
                 self.max_len = cfg.MODEL.MAX_LEN
             else:
@@ -187,10 +318,45 @@ class Howto100m(torch.utils.data.Dataset):
                 self.min_len = 0
             self.sample = cfg.TRAIN.TEXT_SAMPLE
 
-        if hasattr(cfg.TRAIN, "EPOCH_MUL"):
-            self.em = cfg.TRAIN.EPOCH_MUL
+        # Mean and std in the uint8 pixel range, shaped to broadcast over
+        # `channel` x `num frames` x `height` x `width` frames.
+        self._mean = torch.tensor(cfg.DATA.MEAN).view(-1, 1, 1, 1) * 255.0
+        self._std = torch.tensor(cfg.DATA.STD).view(-1, 1, 1, 1) * 255.0
+
+        # One decoding thread per data loader worker; with a single worker let
+        # the decoder pick the number of threads.
+        self._decode_threads = 1 if cfg.DATA_LOADER.NUM_WORKERS > 1 else 0
+
+        self.em = cfg.TRAIN.EPOCH_MUL if hasattr(cfg.TRAIN, "EPOCH_MUL") else 1
+        # The dataset is copied into the data loader workers, which may be kept
+        # alive across epochs (DATA_LOADER.PERSISTENT_WORKERS). Keep its state
+        # on the CPU and picklable: no CUDA tensors, and per-worker resources
+        # (decoders, caches) are created lazily inside the workers.
         logger.info("Constructing HowTo100M {}...".format(mode))
         self._construct_loader()
+        self._construct_sampling_params()
+
+    def _load_packed_emb(self):
+        """
+        Memory-map the embeddings packed by `tools/pack_text_emb.py`, if they
+        exist under TRAIN.TEXT_EMB. Otherwise embeddings are read from the
+        per-video `.npy` files.
+        """
+        self._emb = None
+        if self.caps_emb is None:
+            return
+        path_to_emb = os.path.join(self.caps_emb, PACKED_EMB)
+        path_to_index = os.path.join(self.caps_emb, PACKED_EMB_INDEX)
+        if not (os.path.exists(path_to_emb) and os.path.exists(path_to_index)):
+            return
+        self._emb = np.load(path_to_emb, mmap_mode="r")
+        # Typed arrays rather than a dict of the ~1M videos, for the same
+        # copy-on-write reason as the per-clip fields.
+        with np.load(path_to_index) as index:
+            self._emb_ids = index["ids"]
+            self._emb_offsets = index["offsets"]
+            self._emb_counts = index["counts"]
+        logger.info("Using packed text embeddings from {}".format(path_to_emb))
 
     def _construct_loader(self):
         """
@@ -199,67 +365,373 @@ class Howto100m(torch.utils.data.Dataset):
         path_to_file = os.path.join(
             self.cfg.DATA.PATH_TO_DATA_DIR, "{}.csv".format(self.mode)
         )
-        assert PathManager.exists(path_to_file), "{} dir not found".format(path_to_file)
-
-        self._path_to_videos = []
-        self._labels = []
-        self._durations = []
-        self._start = []
-        self._end = []
-        self._spatial_temporal_idx = []
-        tmp = []
-        with PathManager.open(path_to_file, "r") as f:
-            for clip_idx, path_label in enumerate(f.read().splitlines()):
-                assert (
-                    len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 3
-                    or len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 5
-                    or len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 6
-                )
-                if len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 3:
-                    path, label, duration = path_label.split(
-                        self.cfg.DATA.PATH_LABEL_SEPARATOR
-                    )
-                elif len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 5:
-                    path, label, duration, start, end = path_label.split(
-                        self.cfg.DATA.PATH_LABEL_SEPARATOR
-                    )
-                else:
-                    path, label, duration, start, end, text = path_label.split(
-                        self.cfg.DATA.PATH_LABEL_SEPARATOR
-                    )
-                path = path.split(".")[0]
-                for idx in range(self._num_clips):
-                    self._path_to_videos.append(
-                        os.path.join(self.cfg.DATA.PATH_PREFIX, path)
-                    )
-                    self._labels.append(int(label))
-                    self._durations.append(int(float(duration)))
-                    # self._start.append(float(start))
-                    # self._end.append(float(end))
-                    if len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 3:
-                        self._start.append(None)
-                        self._end.append(None)
-                    else:
-                        self._start.append(int(float(start)))
-                        self._end.append(int(float(end)))
-
-                    self._spatial_temporal_idx.append(idx)
-                    if len(path_label.split(self.cfg.DATA.PATH_LABEL_SEPARATOR)) == 6:
-                        tmp.append(text.replace("<>", " "))
-                    self._video_meta[clip_idx * self._num_clips + idx] = {}
+        assert os.path.exists(path_to_file), "{} dir not found".format(path_to_file)
+
+        # Parse the whole file at once. Every row is either `path label
+        # duration`, `path label duration start end` or `path label duration
+        # start end text`.
+        rows = pd.read_csv(
+            path_to_file,
+            sep=self.cfg.DATA.PATH_LABEL_SEPARATOR,
+            header=None,
+            dtype=str,
+            engine="c",
+            quoting=csv.QUOTE_NONE,
+            keep_default_na=False,
+        )
+        assert rows.shape[1] in [3, 5, 6], "Unexpected columns in {}".format(
+            path_to_file
+        )
         assert (
-            len(self._path_to_videos) > 0
+            len(rows) > 0
         ), "Failed to load HowTo100M split {} from {}".format(
-            self._split_idx, path_to_file
+            self.mode, path_to_file
+        )
+        # Every row is repeated for each of its clips.
+        path_to_videos = [
+            os.path.join(self.cfg.DATA.PATH_PREFIX, path.split(".")[0])
+            for path in rows[0]
+        ]
+        path_to_videos = [
+            path for path in path_to_videos for _ in range(self._num_clips)
+        ]
+        # Keep the per-clip fields as typed arrays rather than lists of Python
+        # objects, which are copied page by page into every forked worker as
+        # their refcounts are touched. Clips without start/end hold NaN.
+        self._labels = np.repeat(
+            rows[1].astype(int).to_numpy(dtype=np.int32), self._num_clips
+        )
+        self._durations = np.repeat(
+            rows[2].astype(float).astype(int).to_numpy(dtype=np.int32),
+            self._num_clips,
+        )
+        if rows.shape[1] == 3:
+            self._start = np.full(len(path_to_videos), np.nan, dtype=np.float32)
+            self._end = np.full(len(path_to_videos), np.nan, dtype=np.float32)
+        else:
+            self._start = np.repeat(
+                rows[3].astype(float).astype(int).to_numpy(dtype=np.float32),
+                self._num_clips,
+            )
+            self._end = np.repeat(
+                rows[4].astype(float).astype(int).to_numpy(dtype=np.float32),
+                self._num_clips,
+            )
+        self._spatial_temporal_idx = np.tile(
+            np.arange(self._num_clips, dtype=np.int32), len(rows)
+        )
+        # The paths are packed into one byte buffer indexed by offsets.
+        path_to_videos = [path.encode("utf-8") for path in path_to_videos]
+        self._path_offsets = np.cumsum(
+            [0] + [len(path) for path in path_to_videos], dtype=np.int64
         )
+        self._path_bytes = np.frombuffer(b"".join(path_to_videos), dtype=np.uint8)
+        self._num_videos = len(path_to_videos)
         logger.info(
             "Constructing kinetics dataloader (size: {}) from {}".format(
-                len(self._path_to_videos), path_to_file
+                self._num_videos, path_to_file
             )
         )
-        if len(tmp) > 0:
-            self.labels = tmp
-            print(len(tmp))
+
+    def _construct_sampling_params(self):
+        """
+        Resolve the mode dependent sampling parameters once. The temporal and
+        spatial sample indices are stored per clip, the scales and crop size
+        are shared by all clips. Frequently used configs are also copied to
+        plain attributes to avoid CfgNode lookups in `__getitem__`, and the
+        mode, text and decoding backend branches are resolved here so that
+        `__getitem__` only runs the code path used by this dataset.
+        """
+        self._fd = self.cfg.DATA.FD
+        self._fix_end = self.cfg.DATA.FIX_END
+        self._num_ensemble_views = self.cfg.TEST.NUM_ENSEMBLE_VIEWS
+        self._sampling_rate = self.cfg.DATA.SAMPLING_RATE
+        self._long_cycle_sampling_rate = self.cfg.MULTIGRID.LONG_CYCLE_SAMPLING_RATE
+        self._jitter_scales = self.cfg.DATA.TRAIN_JITTER_SCALES
+        self._short_cycle_factors = self.cfg.MULTIGRID.SHORT_CYCLE_FACTORS
+        self._default_s = self.cfg.MULTIGRID.DEFAULT_S
+        self._random_flip = self.cfg.DATA.RANDOM_FLIP
+        self._inv_uniform_sample = self.cfg.DATA.INV_UNIFORM_SAMPLE
+        self._pack_pathway = self.cfg.MODEL.ARCH not in ["vit", "swin3d"]
+        self._fp16 = self.cfg.DATA.FP16
+        # Only the vit patch embedding casts the frames back to its dtype.
+        assert not self._fp16 or self.cfg.MODEL.ARCH in [
+            "vit"
+        ], "DATA.FP16 is not supported by MODEL.ARCH {}".format(self.cfg.MODEL.ARCH)
+        if self.mode in ["train", "val"]:
+            # -1 indicates random sampling.
+            self._temporal_idx = np.full(self._num_videos, -1, dtype=np.int32)
+            self._spatial_idx = np.full(self._num_videos, -1, dtype=np.int32)
+            self._min_scale = self._jitter_scales[0]
+            self._max_scale = self._jitter_scales[1]
+            self._crop_size = self.cfg.DATA.TRAIN_CROP_SIZE
+            if self._default_s > 0:
+                # Decreasing the scale is equivalent to using a larger "span"
+                # in a sampling grid.
+                self._min_scale = int(
+                    round(
+                        float(self._min_scale) * self._crop_size / self._default_s
+                    )
+                )
+            self._get_clip_params = self._get_clip_params_train
+        elif self.mode in ["test"]:
+            num_spatial_crops = self.cfg.TEST.NUM_SPATIAL_CROPS
+            self._temporal_idx = self._spatial_temporal_idx // num_spatial_crops
+            # spatial_sample_index is in [0, 1, 2]. Corresponding to left,
+            # center, or right if width is larger than height, and top, middle,
+            # or bottom if height is larger than width.
+            if num_spatial_crops > 1:
+                self._spatial_idx = self._spatial_temporal_idx % num_spatial_crops
+            else:
+                self._spatial_idx = np.ones(self._num_videos, dtype=np.int32)
+            self._min_scale, self._max_scale, self._crop_size = (
+                [self.cfg.DATA.TEST_CROP_SIZE] * 3
+                if num_spatial_crops > 1
+                else [self._jitter_scales[0]] * 2 + [self.cfg.DATA.TEST_CROP_SIZE]
+            )
+            # The testing is deterministic and no jitter should be performed.
+            # min_scale, max_scale, and crop_size are expect to be the same.
+            assert len({self._min_scale, self._max_scale}) == 1
+            self._get_clip_params = self._get_clip_params_test
+        else:
+            raise NotImplementedError("Does not support {} mode".format(self.mode))
+
+        # A caption is sampled for every clip whenever captions are given.
+        self._sample_captions = self.caps is not None
+        self._tokenize = self.textind and (self.sample < 1 or "train" not in self.mode)
+        # Only the clips of a video in testing are consecutive. In training
+        # and validation every video is read once per epoch in random order,
+        # so a per-video token cache would never hit.
+        self._cache_tokens = self.mode in ["test"]
+        backend = self.cfg.DATA.DECODING_BACKEND
+        if backend == "decord":
+            self._decode_fn = get_video
+        elif backend == "ffmpeg":
+            self._decode_fn = get_video_ffmpeg
+        else:
+            # Decode through a video container with `decoder.decode`.
+            self._decode_fn = None
+
+    def _get_clip_params_train(self, index, short_cycle_idx):
+        """
+        Return the temporal and spatial sample indices, the scales and the
+        crop size of a training or validation clip.
+        """
+        min_scale = self._min_scale
+        crop_size = self._crop_size
+        if short_cycle_idx in [0, 1]:
+            crop_size = int(
+                round(self._short_cycle_factors[short_cycle_idx] * self._default_s)
+            )
+            if self._default_s > 0:
+                min_scale = int(
+                    round(float(self._jitter_scales[0]) * crop_size / self._default_s)
+                )
+        return -1, -1, min_scale, self._max_scale, crop_size
+
+    def _get_clip_params_test(self, index, short_cycle_idx):
+        """
+        Return the temporal and spatial sample indices, the scales and the
+        crop size of a testing clip.
+        """
+        return (
+            int(self._temporal_idx[index]),
+            int(self._spatial_idx[index]),
+            self._min_scale,
+            self._max_scale,
+            self._crop_size,
+        )
+
+    def _get_path(self, index):
+        """
+        Decode the path to the video of the given clip index from the packed
+        path buffer.
+        """
+        start, end = self._path_offsets[index], self._path_offsets[index + 1]
+        return self._path_bytes[start:end].tobytes().decode("utf-8")
+
+    def _sample_caption(self, vidid, start, end):
+        """
+        Select the ASR sentence of the clip: a random one if the clip has no
+        start and end time, otherwise the one overlapping the most with it.
+        Args:
+            vidid (str): id of the video.
+            start (float): start time of the clip, NaN if unknown.
+            end (float): end time of the clip, NaN if unknown.
+        Returns:
+            start (float): start time of the selected sentence.
+            end (float): end time of the selected sentence.
+            text (dict): the tokenized sentence, None if not tokenized.
+            cap_emb (ndarray): the embedding of the sentence, None if no
+                embeddings are given.
+        """
+        path_to_caption = self.caps + vidid + ".csv"
+        cap_text, cap_start, cap_end = load_captions(path_to_caption)
+
+        # Random ASR sentence gets chosen here
+        if math.isnan(start):
+            ind = random.randint(0, len(cap_text) - 1)
+        else:
+            # Pick the sentence with the largest temporal overlap.
+            overlap = np.maximum(
+                np.minimum(cap_end, end) - np.maximum(cap_start, start), 0
+            )
+            ind = int(np.argmax(overlap))
+
+        if self._emb is not None:
+            pos = np.searchsorted(self._emb_ids, vidid)
+            if pos == len(self._emb_ids) or self._emb_ids[pos] != vidid:
+                raise KeyError(vidid)
+            offset = int(self._emb_offsets[pos])
+            count = int(self._emb_counts[pos])
+            if ind >= count:
+                # Same error as indexing the per-video embeddings below.
+                raise IndexError(
+                    "index {} is out of bounds for the {} embeddings of {}".format(
+                        ind, count, vidid
+                    )
+                )
+            cap_emb = self._emb[offset + ind].astype(np.float32)
+        elif self.caps_emb is not None:
+            cap_emb = np.load(self.caps_emb + vidid + ".npy")[ind, :]
+        else:
+            cap_emb = None
+        sen = cap_text[ind]
+        cap_s = cap_start[ind]
+        cap_e = cap_end[ind]
+        merged = False
+        if self.min_len > 0:
+            mi = 0
+            q = sen if isinstance(sen, str) else " "
+            while len(q.split(" ")) < self.min_len:
+                merged = True
+                if ind - mi > 0 and isinstance(cap_text[ind - mi], str):
+                    q = cap_text[ind - mi] + " " + q
+                    cap_s = cap_start[ind - mi]
+                if ind + mi < len(cap_text) and isinstance(cap_text[ind + mi], str):
+                    q = q + " " + cap_text[ind + mi]
+                    cap_e = cap_end[ind + mi]
+                mi += 1
+                if not ind - mi > 0 and not ind + mi < len(cap_text):
+                    break
+            sen = q
+        text = None
+        if self._tokenize and (merged or not self._cache_tokens):
+            if not isinstance(sen, str) or len(sen) == 0:
+                sen = " "
+            text = self.tokenizer.encode_plus(
+                sen,
+                max_length=self.max_len,
+                padding="max_length",
+                truncation=True,
+                add_special_tokens=True,
+                return_tensors="pt",
+            )
+        elif self._tokenize:
+            # Sentences of a video are tokenized together once. The row is
+            # copied back to int64, so only it is sent to the main process.
+            tokens = tokenize_captions(
+                path_to_caption, self.cfg.MODEL.TEXT_MODEL, self.max_len
+            )
+            text = {k: v[ind : ind + 1].long() for k, v in tokens.items()}
+        return cap_s, cap_e, text, cap_emb
+
+    def _sample_clip(self, index, path_to_video, temporal_sample_index):
+        """
+        Compute the start and end time (in seconds) of the clip to decode,
+        together with its caption if captions are given.
+        Returns:
+            start (float): start time of the clip.
+            end (float): end time of the clip.
+            duration (int): duration of the video.
+            text (dict): the tokenized caption, None if not tokenized.
+            cap_emb (ndarray): the embedding of the caption, None if not given.
+        """
+        duration = int(self._durations[index])
+        start = float(self._start[index])
+        end = float(self._end[index])
+
+        text = None
+        cap_emb = None
+        if self._sample_captions:
+            # The extension is already stripped from the stored paths.
+            vidid = os.path.basename(path_to_video)
+            start, end, text, cap_emb = self._sample_caption(vidid, start, end)
+        if math.isnan(start):
+            start, end = get_start_end_idx(
+                duration,
+                self._fd,
+                temporal_sample_index,
+                self._num_ensemble_views,
+            )
+        if end - start < self._fd - 1:
+            start = max((end + start) / 2.0 - self._fd / 2.0, 0)
+            end = min(start + self._fd, duration)
+        try:
+            if end - start > self._num_frames and self._fd == 0.0:
+                new_end = (end + start) / 2.0 + self._num_frames / 2.0
+                new_start = (end + start) / 2.0 - self._num_frames / 2.0
+                start = new_start
+                end = new_end
+            elif self._fd > 0.0 and self._fd < end - start:
+                startb, endb = start, end
+                start, end = get_start_end_idx(
+                    end - start,
+                    self._fd,
+                    temporal_sample_index,
+                    self._num_ensemble_views,
+                )
+                start += startb
+                end += startb
+        except:
+            end = end
+        if self._fix_end:
+            start = float(self._start[index])
+            end = float(self._end[index])
+            if self._fd < end - start:
+                start, end = get_start_end_idx(
+                    end - start,
+                    self._fd,
+                    temporal_sample_index,
+                    self._num_ensemble_views,
+                )
+        return start, end, duration, text, cap_emb
+
+    def _process_frames(
+        self, frames, spatial_sample_index, min_scale, max_scale, crop_size
+    ):
+        """
+        Normalize, spatially sample and pack the decoded frames.
+        Args:
+            frames (tensor): decoded uint8 frames, dimension is
+                `num frames` x `height` x `width` x `channel`.
+        Returns:
+            frames (tensor or list): the processed frames, dimension is
+                `channel` x `num frames` x `height` x `width`.
+        """
+        # T H W C -> C T H W on the uint8 frames, then convert the
+        # contiguous buffer once and perform color normalization in place.
+        frames = frames.permute(3, 0, 1, 2).contiguous().float()
+        frames = utils.tensor_normalize_fast(frames, self._mean, self._std)
+
+        # Perform data augmentation.
+        frames = utils.spatial_sampling(
+            frames,
+            spatial_idx=spatial_sample_index,
+            min_scale=min_scale,
+            max_scale=max_scale,
+            crop_size=crop_size,
+            random_horizontal_flip=self._random_flip,
+            inverse_uniform_sampling=self._inv_uniform_sample,
+        )
+
+        if self._fp16:
+            # Cast after spatial sampling, which needs float32 on the CPU.
+            frames = frames.half()
+
+        if self._pack_pathway:
+            frames = utils.pack_pathway_output(self.cfg, frames)
+        return frames
 
     def __getitem__(self, index):
         """
@@ -280,200 +752,60 @@ class Howto100m(torch.utils.data.Dataset):
         # When short cycle is used, input index is a tupple.
         if isinstance(index, tuple):
             index, short_cycle_idx = index
-        if hasattr(self, "em") and self.em > 1:
-            index = index % len(self._path_to_videos)
-        if self.mode in ["train", "val"]:
-            # -1 indicates random sampling.
-            temporal_sample_index = -1
-            spatial_sample_index = -1
-            min_scale = self.cfg.DATA.TRAIN_JITTER_SCALES[0]
-            max_scale = self.cfg.DATA.TRAIN_JITTER_SCALES[1]
-            crop_size = self.cfg.DATA.TRAIN_CROP_SIZE
-            if short_cycle_idx in [0, 1]:
-                crop_size = int(
-                    round(
-                        self.cfg.MULTIGRID.SHORT_CYCLE_FACTORS[short_cycle_idx]
-                        * self.cfg.MULTIGRID.DEFAULT_S
-                    )
-                )
-            if self.cfg.MULTIGRID.DEFAULT_S > 0:
-                # Decreasing the scale is equivalent to using a larger "span"
-                # in a sampling grid.
-                min_scale = int(
-                    round(float(min_scale) * crop_size / self.cfg.MULTIGRID.DEFAULT_S)
-                )
-        elif self.mode in ["test"]:
-            temporal_sample_index = (
-                self._spatial_temporal_idx[index] // self.cfg.TEST.NUM_SPATIAL_CROPS
-            )
-            # spatial_sample_index is in [0, 1, 2]. Corresponding to left,
-            # center, or right if width is larger than height, and top, middle,
-            # or bottom if height is larger than width.
-            spatial_sample_index = (
-                (self._spatial_temporal_idx[index] % self.cfg.TEST.NUM_SPATIAL_CROPS)
-                if self.cfg.TEST.NUM_SPATIAL_CROPS > 1
-                else 1
-            )
-            min_scale, max_scale, crop_size = (
-                [self.cfg.DATA.TEST_CROP_SIZE] * 3
-                if self.cfg.TEST.NUM_SPATIAL_CROPS > 1
-                else [self.cfg.DATA.TRAIN_JITTER_SCALES[0]] * 2
-                + [self.cfg.DATA.TEST_CROP_SIZE]
-            )
-            # The testing is deterministic and no jitter should be performed.
-            # min_scale, max_scale, and crop_size are expect to be the same.
-            assert len({min_scale, max_scale}) == 1
-        else:
-            raise NotImplementedError("Does not support {} mode".format(self.mode))
+        if self.em > 1:
+            index = index % self._num_videos
+        (
+            temporal_sample_index,
+            spatial_sample_index,
+            min_scale,
+            max_scale,
+            crop_size,
+        ) = self._get_clip_params(index, short_cycle_idx)
         sampling_rate = utils.get_random_sampling_rate(
-            self.cfg.MULTIGRID.LONG_CYCLE_SAMPLING_RATE,
-            self.cfg.DATA.SAMPLING_RATE,
+            self._long_cycle_sampling_rate, self._sampling_rate
         )
         # Try to decode and sample a clip from a video. If the video can not be
         # decoded, repeatly find a random video replacement that can be decoded.
         for i_try in range(self._num_retries):
+            path_to_video = self._get_path(index)
             video_container = None
-            if not self.cfg.DATA.DECODING_BACKEND == "ffmpeg":
+            if self._decode_fn is None:
                 try:
                     video_container = container.get_video_container(
-                        self._path_to_videos[index],
+                        path_to_video,
                         self.cfg.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE,
                         self.cfg.DATA.DECODING_BACKEND,
                     )
                 except Exception as e:
                     logger.info(
                         "Failed to load video from {} with error {}".format(
-                            self._path_to_videos[index], e
+                            path_to_video, e
                         )
                     )
                 # Select a random video if the current video was not able to access.
                 if video_container is None:
                     logger.warning(
                         "Failed to meta load video idx {} from {}; trial {}".format(
-                            index, self._path_to_videos[index], i_try
+                            index, path_to_video, i_try
                         )
                     )
                     if self.mode not in ["test"] and i_try > self._num_retries // 2:
                         # let's try another one
-                        index = random.randint(0, len(self._path_to_videos) - 1)
+                        index = random.randint(0, self._num_videos - 1)
 
                     continue
 
-            duration = self._durations[index]
-            start = self._start[index]
-            end = self._end[index]
-
-            sid = None
-            words = None
-            text = None
-            if (start == None or type(self.caps) == type(" ")) and not (
-                self.caps == None and self.labels == None
-            ):
-                print("Index here: ", index)
-                vidid = self._path_to_videos[index].split("/")[-1].split(".")[0]
-
-                cap = pd.read_csv(self.caps + vidid + ".csv")
-
-                # Random ASR sentence gets chosen here
-                if start == None:
-                    ind = random.randint(0, len(cap) - 1)
-                else:
-                    temp = []
-                    for i in range(len(cap)):
-                        temp.append(
-                            check_time(
-                                start, end, cap["start"].values[i], cap["end"].values[i]
-                            )
-                        )
-                    ind = np.argmax(temp)
-
-                if hasattr(self, "caps_emb") and not self.caps_emb == None:
-                    cap_emb = np.load(self.caps_emb + vidid + ".npy")[ind, :]
-                else:
-                    cap_emb = None
-                if hasattr(self, "min_len") and self.min_len > 0:
-                    mi = 0
-                    q = cap["text"].values[ind]
-                    q = q if isinstance(q, str) else " "
-                    s = cap["start"].values[ind]
-                    e = cap["end"].values[ind]
-                    while len(q.split(" ")) < self.min_len:
-                        if ind - mi > 0 and isinstance(
-                            cap["text"].values[ind - mi], str
-                        ):
-                            q = cap["text"].values[ind - mi] + " " + q
-                            s = cap["start"].values[ind - mi]
-                        if ind + mi < len(cap) and isinstance(
-                            cap["text"].values[ind + mi], str
-                        ):
-                            q = q + " " + cap["text"].values[ind + mi]
-                            e = cap["end"].values[ind + mi]
-                        mi += 1
-                        if not ind - mi > 0 and not ind + mi < len(cap):
-                            break
-                    cap["text"].values[ind] = q
-                    cap["start"].values[ind] = s
-                    cap["end"].values[ind] = e
-                if self.sample < 1 or (not "train" in self.mode):
-                    sen = cap["text"].values[ind]
-                    if not type(sen) == type(" ") or len(sen) == 0:
-                        sen = " "
-                    text = self.tokenizer.encode_plus(
-                        sen,
-                        max_length=self.max_len,
-                        padding="max_length",
-                        truncation=True,
-                        add_special_tokens=True,
-                        return_tensors="pt",
-                    )
-
-                start, end = cap["start"].values[ind], cap["end"].values[ind]
-            if start == None:
-                start, end = get_start_end_idx(
-                    duration,
-                    self.cfg.DATA.FD,
-                    temporal_sample_index,
-                    self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
-                )
-            if end - start < self.cfg.DATA.FD - 1:
-                start = max((end + start) / 2.0 - self.cfg.DATA.FD / 2.0, 0)
-                end = min(start + self.cfg.DATA.FD, duration)
-            try:
-                if end - start > self.cfg.DATA.NUM_FRAMES and self.cfg.DATA.FD == 0.0:
-                    new_end = (end + start) / 2.0 + self.cfg.DATA.NUM_FRAMES / 2.0
-                    new_start = (end + start) / 2.0 - self.cfg.DATA.NUM_FRAMES / 2.0
-                    start = new_start
-                    end = new_end
-                elif self.cfg.DATA.FD > 0.0 and self.cfg.DATA.FD < end - start:
-                    startb, endb = start, end
-                    start, end = get_start_end_idx(
-                        end - start,
-                        self.cfg.DATA.FD,
-                        temporal_sample_index,
-                        self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
-                    )
-                    start += startb
-                    end += startb
-            except:
-                end = end
-            if hasattr(self.cfg.DATA, "FIX_END") and self.cfg.DATA.FIX_END:
-                start = self._start[index]
-                end = self._end[index]
-                if self.cfg.DATA.FD < end - start:
-                    start, end = get_start_end_idx(
-                        end - start,
-                        self.cfg.DATA.FD,
-                        temporal_sample_index,
-                        self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
-                    )
+            start, end, duration, text, cap_emb = self._sample_clip(
+                index, path_to_video, temporal_sample_index
+            )
 
-            if not self.cfg.DATA.DECODING_BACKEND == "ffmpeg":
+            if self._decode_fn is None:
                 frames = decoder.decode(
                     video_container,
                     sampling_rate,
-                    self.cfg.DATA.NUM_FRAMES,
+                    self._num_frames,
                     temporal_sample_index,
-                    self.cfg.TEST.NUM_ENSEMBLE_VIEWS,
+                    self._num_ensemble_views,
                     video_meta=self._video_meta[index],
                     target_fps=self.cfg.DATA.TARGET_FPS,
                     backend=self.cfg.DATA.DECODING_BACKEND,
@@ -484,11 +816,12 @@ class Howto100m(torch.utils.data.Dataset):
                 )
             else:
                 try:
-                    frames = get_video(
-                        self._path_to_videos[index],
+                    frames = self._decode_fn(
+                        path_to_video,
                         start,
                         end,
-                        self.cfg.DATA.NUM_FRAMES,
+                        self._num_frames,
+                        self._decode_threads,
                     )
                 except:
                     frames = None
@@ -498,44 +831,27 @@ class Howto100m(torch.utils.data.Dataset):
             if frames is None:
                 logger.warning(
                     "Failed to decode video idx {} from {}; trial {}".format(
-                        index, self._path_to_videos[index], i_try
+                        index, path_to_video, i_try
                     )
                 )
                 if self.mode not in ["test"]:  # and i_try > self._num_retries // 4:
                     # let's try another one
-                    index = random.randint(0, len(self._path_to_videos) - 1)
+                    index = random.randint(0, self._num_videos - 1)
                 if self.mode in ["test"] and i_try > self._num_retries // 2:
                     # let's try another one
-                    index = random.randint(0, len(self._path_to_videos) - 1)
+                    index = random.randint(0, self._num_videos - 1)
                 continue
-            # Perform color normalization.
-            frames = utils.tensor_normalize(
-                frames, self.cfg.DATA.MEAN, self.cfg.DATA.STD
-            )
-            # T H W C -> C T H W.
-            frames = frames.permute(3, 0, 1, 2)
-
-            # Perform data augmentation.
-            frames = utils.spatial_sampling(
-                frames,
-                spatial_idx=spatial_sample_index,
-                min_scale=min_scale,
-                max_scale=max_scale,
-                crop_size=crop_size,
-                random_horizontal_flip=self.cfg.DATA.RANDOM_FLIP,
-                inverse_uniform_sampling=self.cfg.DATA.INV_UNIFORM_SAMPLE,
-            )
 
-            label = self._labels[index]
-
-            if not self.cfg.MODEL.ARCH in ["vit", "swin3d"]:
-                frames = utils.pack_pathway_output(self.cfg, frames)
+            frames = self._process_frames(
+                frames, spatial_sample_index, min_scale, max_scale, crop_size
+            )
+            label = int(self._labels[index])
 
             if self.textind:
-                if text == None:
-                    text = {"text": words}
+                if text is None:
+                    text = {"text": None}
                 text["label"] = torch.tensor([1] + [0] * self.sample)
-                if hasattr(self, "caps_emb") and not self.caps_emb == None:
+                if self.caps_emb is not None:
                     text["emb"] = cap_emb
                 return frames, label, index, text
 
@@ -546,7 +862,7 @@ class Howto100m(torch.utils.data.Dataset):
         Returns:
             (int): the number of videos in the dataset.
         """
-        if hasattr(self, "em") and self.em > 1 and self.mode == "train":
-            return len(self._path_to_videos) * self.em
+        if self.em > 1 and self.mode == "train":
+            return self._num_videos * self.em
         else:
-            return len(self._path_to_videos)
+            return self._num_videos
@@ -101,6 +101,12 @@ def construct_loader(cfg, split, is_precise_bn=False):
     # Construct the dataset
     dataset = build_dataset(dataset_name, cfg, split)
 
+    # Worker options, only accepted by the DataLoader with worker processes.
+    worker_kwargs = {}
+    if cfg.DATA_LOADER.NUM_WORKERS > 0:
+        worker_kwargs["persistent_workers"] = cfg.DATA_LOADER.PERSISTENT_WORKERS
+        worker_kwargs["prefetch_factor"] = cfg.DATA_LOADER.PREFETCH_FACTOR
+
     if cfg.MULTIGRID.SHORT_CYCLE and split in ["train"] and not is_precise_bn:
         # Create a sampler for multi-process training
         sampler = utils.create_sampler(dataset, shuffle, cfg)
@@ -114,6 +120,7 @@ def construct_loader(cfg, split, is_precise_bn=False):
             num_workers=cfg.DATA_LOADER.NUM_WORKERS,
             pin_memory=cfg.DATA_LOADER.PIN_MEMORY,
             worker_init_fn=utils.loader_worker_init_fn(dataset),
+            **worker_kwargs,
         )
     else:
         # Create a sampler for multi-process training
@@ -135,10 +142,68 @@ def construct_loader(cfg, split, is_precise_bn=False):
             drop_last=drop_last,
             collate_fn=collate,
             worker_init_fn=utils.loader_worker_init_fn(dataset),
+            **worker_kwargs,
         )
     return loader
 
 
+def _to_cuda(data):
+    """
+    Recursively copy the tensors in a (nested) batch to the current GPU.
+    """
+    if isinstance(data, torch.Tensor):
+        return data.cuda(non_blocking=True)
+    if isinstance(data, (list, tuple)):
+        return type(data)(_to_cuda(d) for d in data)
+    if isinstance(data, dict):
+        return {k: _to_cuda(v) for k, v in data.items()}
+    return data
+
+
+def _record_stream(data, stream):
+    """
+    Mark the tensors in a (nested) batch as used by the given stream, so their
+    memory is not reused before the stream is done with them.
+    """
+    if isinstance(data, torch.Tensor):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            _record_stream(d, stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            _record_stream(v, stream)
+
+
+class CUDAPrefetcher:
+    """
+    Wrap a data loader to copy the next batch to the current GPU on a side
+    CUDA stream while the current batch is being processed. The copies only
+    overlap with compute if the loader uses pinned memory.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = _to_cuda(next_batch)
+            if batch is not None:
+                yield batch
+            # The compute stream waits for the copies before using the batch.
+            torch.cuda.current_stream().wait_stream(stream)
+            _record_stream(next_batch, torch.cuda.current_stream())
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+
 def shuffle_dataset(loader, cur_epoch):
     """ "
     Shuffles the data.
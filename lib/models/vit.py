@@ -239,7 +239,8 @@ class PatchEmbed(nn.Module):
     def forward(self, x):
         B, C, T, H, W = x.shape
         x = rearrange(x, "b c t h w -> (b t) c h w")
-        x = self.proj(x)
+        # Frames may be loaded in float16 (DATA.FP16).
+        x = self.proj(x.to(self.proj.weight.dtype))
         W = x.size(-1)
         x = x.flatten(2).transpose(1, 2)
         return x, T, W
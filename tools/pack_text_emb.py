@@ -0,0 +1,85 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates. All Rights Reserved.
+"""
+A script to pack the per-video ASR sentence embeddings (TRAIN.TEXT_EMB) into
+a single memory-mappable array, so the HowTo100M loader reads one row per
+sample instead of opening a `.npy` file per sample.
+"""
+
+import argparse
+import os
+import numpy as np
+
+from lib.datasets.howto100m import PACKED_EMB, PACKED_EMB_INDEX
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pack per-video text embeddings into one .npy file."
+    )
+    parser.add_argument(
+        "--emb_dir",
+        help="Directory with one <video_id>.npy embedding file per video",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "--output_dir",
+        help="Directory to write the packed files to, defaults to emb_dir",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--dtype",
+        help="Data type of the packed embeddings",
+        default="float16",
+        type=str,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output_dir = args.output_dir if args.output_dir else args.emb_dir
+    names = sorted(
+        name
+        for name in os.listdir(args.emb_dir)
+        if name.endswith(".npy") and name != PACKED_EMB
+    )
+    assert len(names) > 0, "No embeddings found in {}".format(args.emb_dir)
+
+    # First pass only reads the headers to lay out the packed array. The
+    # names are sorted, so are the ids.
+    ids = [name[: -len(".npy")] for name in names]
+    counts = np.zeros(len(names), dtype=np.int64)
+    dim = None
+    for i, name in enumerate(names):
+        shape = np.load(os.path.join(args.emb_dir, name), mmap_mode="r").shape
+        assert dim is None or shape[1] == dim, "Inconsistent dim in {}".format(
+            name
+        )
+        dim = shape[1]
+        counts[i] = shape[0]
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    total = int(counts.sum())
+
+    packed = np.lib.format.open_memmap(
+        os.path.join(output_dir, PACKED_EMB),
+        mode="w+",
+        dtype=np.dtype(args.dtype),
+        shape=(total, dim),
+    )
+    for name, start, count in zip(names, offsets, counts):
+        packed[start : start + count] = np.load(os.path.join(args.emb_dir, name))
+    packed.flush()
+
+    np.savez(
+        os.path.join(output_dir, PACKED_EMB_INDEX),
+        ids=np.array(ids),
+        offsets=offsets,
+        counts=counts,
+    )
+    print("Packed {} embeddings of {} videos".format(total, len(names)))
+
+
+if __name__ == "__main__":
+    main()
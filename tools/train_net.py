@@ -102,6 +102,8 @@ def train_epoch(
     else:
         if hasattr(model.model, "text_model"):
             model.mode.text_model.eval()
+    if cfg.NUM_GPUS and cfg.DATA_LOADER.CUDA_PREFETCH:
+        train_loader = loader.CUDAPrefetcher(train_loader)
     train_meter.iter_tic()
     data_size = len(train_loader)
 